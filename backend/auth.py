@@ -16,9 +16,9 @@ ALGORITHM = "HS256"
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl='login')
 
 
-def get_user_from_db(session, id):
+async def get_user_from_db(session, id):
     statement = select(User).where(User.id == id)
-    user = session.exec(statement).first()
+    user = (await session.exec(statement)).first()
     return user
 
 
@@ -30,7 +30,7 @@ def create_access_token(data: dict, expires_delta: timedelta = timedelta(minutes
     return encoded_jwt
 
 
-def get_current_user(token: Annotated[str, Depends(oauth2_scheme)], session: SessionDep) -> User:
+async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)], session: SessionDep) -> User:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate Credentials",
@@ -52,13 +52,13 @@ def get_current_user(token: Annotated[str, Depends(oauth2_scheme)], session: Ses
     except InvalidTokenError:
         raise credentials_exception
     
-    user = get_user_from_db(session, token_data.id)
+    user = await get_user_from_db(session, token_data.id)
     if not user:
         raise credentials_exception
     return user
 
 
-def get_current_admin_user(current_user: Annotated[User, Depends(get_current_user)]) -> User:
+async def get_current_admin_user(current_user: Annotated[User, Depends(get_current_user)]) -> User:
     if not current_user.is_admin:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
@@ -1,29 +1,58 @@
-from fastapi import FastAPI, Depends, HTTPException, status, Query
+from fastapi import FastAPI, Depends, HTTPException, status, Query, Request
+from fastapi.responses import JSONResponse
 from fastapi.security import OAuth2PasswordRequestForm
 from typing import Annotated, List
 from models import User, Item, Bid, Comment, Watchlist, Report
-from database import init_db, SessionDep, engine
-from sqlmodel import select, Session, update
-from sqlalchemy import desc, func
+from database import init_db, SessionDep, engine, MARK_ENDED_AUCTIONS_LOCK_KEY
+from sqlmodel import select, update
+from sqlalchemy import desc, func, bindparam
+from sqlalchemy.orm import selectinload, lazyload, raiseload, aliased
 from dotenv import load_dotenv
+import logging
 import os
 from datetime import timedelta, timezone, datetime
 from auth import create_access_token, get_current_user, get_current_admin_user
-from schemas import Token, RegisterUser, ItemForm, ItemRead, CommentCreate, CommentRead, BidRead, BidCreate, ItemBidInfo, UserBidRead
-from utils import get_password_hash, verify_password, USERNAME_REGEX, PASSWORD_REGEX, NUMBER_REGEX, AUCTION_CATEGORIES
-import re
+from schemas import Token, RegisterUser, UserProfile, ItemForm, ItemRead, ItemListRead, ItemListPage, CommentCreate, CommentRead, BidRead, BidCreate, ItemBidInfo, ItemBidInfoPage, UserBidRead
+from utils import get_password_hash_async, verify_password_async, password_needs_rehash, validate_username, validate_password, validate_number, AUCTION_CATEGORIES, AUCTION_CATEGORIES_LIST
 from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 from fastapi_utils.tasks import repeat_every
 from fastapi.staticfiles import StaticFiles
 import time
+import aiofiles
 from fastapi.middleware.cors import CORSMiddleware
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+# Read once at startup, a missing or malformed value fails here instead of on the first login
+ACCESS_TOKEN_EXPIRE_MINUTES = int(os.environ['ACCESS_TOKEN_EXPIRE_MINUTES'])
+ACCESS_TOKEN_EXPIRES = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+
 
 app = FastAPI()
 
-init_db()
+
+@app.on_event('startup')
+async def on_startup():
+    await init_db()
+
+
+# Registered before CORS so that rejected uploads still get the CORS headers
+@app.middleware("http")
+async def limit_item_upload_size(request: Request, call_next):
+    """
+    Rejects item uploads with a too large Content-Length before the body is read
+    """
+    if request.method == "POST" and request.url.path == "/items":
+        content_length = request.headers.get('content-length')
+        if content_length and content_length.isdigit() and int(content_length) > MAX_ITEM_REQUEST_SIZE:
+            return JSONResponse(
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                content={"detail": f"Image size must be less than {MAX_IMAGE_SIZE // (1024 * 1024)} MB"}
+            )
+    return await call_next(request)
+
 
 # For allowing frontend origin
 origins = [
@@ -44,33 +73,85 @@ CurrentUserDep = Annotated[User, Depends(get_current_user)]
 CurrentAdminDep = Annotated[User, Depends(get_current_admin_user)]
 
 # Image configurations
-ALLOWED_IMAGE_TYPES = ["image/jpeg", "image/png", "image/webp", "image/gif"]
+ALLOWED_IMAGE_TYPES = frozenset({"image/jpeg", "image/png", "image/webp", "image/gif"})
+ALLOWED_IMAGE_TYPES_STR = ", ".join(sorted(ALLOWED_IMAGE_TYPES))
 MAX_IMAGE_SIZE = 5 * 1024 * 1024
+IMAGE_CHUNK_SIZE = 64 * 1024
+# Image plus some room for the other form fields
+MAX_ITEM_REQUEST_SIZE = MAX_IMAGE_SIZE + 1024 * 1024
+
+
+# Pagination configurations
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
 
 
 # Default item image path
 DEFAULT_ITEM_IMAGE = '/static/uploads/item.jpg'
 
 
+# In debug mode list queries raise on any lazy relationship load instead of silently firing one query per row.
+# If a list endpoint needs a relationship, load it explicitly with selectinload(...) on the query.
+LIST_QUERY_OPTIONS = [raiseload('*')] if os.getenv('DEBUG') else []
+
+
+# Statements of the ended auctions job, built once at import. They take no per-tick values
+# (the ended ids are an expanding bind parameter) so SQLAlchemy reuses their compiled form on every tick
+
+# Skips the tick if another worker is already closing auctions, the lock is released on commit
+TRY_LOCK_ENDED_AUCTIONS = select(func.pg_try_advisory_xact_lock(MARK_ENDED_AUCTIONS_LOCK_KEY))
+
+# Built on the Core tables, the job runs on a plain connection and needs no ORM entity handling
+_items = Item.__table__
+_bids = Bid.__table__
+
+# Only touch auctions that are still active, served by the partial index on end_at
+CLOSE_ENDED_AUCTIONS = (
+    update(_items)
+    .where(_items.c.end_at <= func.now(), _items.c.is_active)
+    .values(is_active=False)
+    .returning(_items.c.id)
+)
+
+# Highest bid wins, earliest bid breaks the tie
+_winners = (
+    select(_bids.c.item_id, _bids.c.user_id)
+    .where(_bids.c.item_id.in_(bindparam("ended_ids", expanding=True)))
+    .order_by(_bids.c.item_id, desc(_bids.c.bid), _bids.c.created_at)
+    .distinct(_bids.c.item_id)
+    .subquery()
+)
+# Set every winner in a single UPDATE ... FROM statement, RETURNING gives the results without another SELECT
+SET_AUCTION_WINNERS = (
+    update(_items)
+    .where(_items.c.id == _winners.c.item_id)
+    .values(winner_id=_winners.c.user_id)
+    .returning(_items.c.id, _items.c.winner_id)
+)
+
+
 # Function that runs every 60 seconds to mark the is_active status to True if end date is crossed
 @app.on_event('startup')
 @repeat_every(seconds=60)
-def mark_ended_auctions():
+async def mark_ended_auctions():
     """
     Marks the is_active status of a product to true when the active time period of the auction ends
     """
-    with Session(engine) as session:
-        stmt = (
-            update(Item)
-            .where(Item.end_at <= datetime.now(timezone.utc))
-            .values(is_active=False)
-        )
-        session.exec(stmt)
-        session.commit()
+    # A plain pooled connection is enough here, none of the statements need the ORM session bookkeeping
+    async with engine.begin() as conn:
+        if not (await conn.execute(TRY_LOCK_ENDED_AUCTIONS)).scalar():
+            return
+
+        ended_ids = (await conn.execute(CLOSE_ENDED_AUCTIONS)).scalars().all()
+
+        if ended_ids:
+            won = (await conn.execute(SET_AUCTION_WINNERS, {"ended_ids": ended_ids})).all()
+            for item_id, winner_id in won:
+                logger.info("Auction %s ended, won by user %s", item_id, winner_id)
 
 
 @app.post("/login", response_model=Token)
-def login(form_data: Annotated[OAuth2PasswordRequestForm, Depends()], session: SessionDep):
+async def login(form_data: Annotated[OAuth2PasswordRequestForm, Depends()], session: SessionDep):
     """
     Login into the auction app
     """
@@ -84,28 +165,36 @@ def login(form_data: Annotated[OAuth2PasswordRequestForm, Depends()], session: S
         )
     
     query = select(User).where(User.username == username)
-    user = session.exec(query).first()
+    user = (await session.exec(query)).first()
 
-    if not user:
+    # Always run exactly one verify, an unknown username is checked against a dummy hash and never matches
+    if not await verify_password_async(password, user.password if user else None):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid Username or Password"
         )
 
-    if not verify_password(password, user.password):
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Invalid Username or Password"
-        )
-    access_token_expires = timedelta(minutes=int(os.getenv('ACCESS_TOKEN_EXPIRE_MINUTES')))
+    # Read before the rehash, a rollback there expires the user
+    user_id = user.id
+
+    # Upgrade legacy bcrypt or outdated argon2 hashes while the plain password is at hand
+    if password_needs_rehash(user.password):
+        try:
+            user.password = await get_password_hash_async(password)
+            session.add(user)
+            await session.commit()
+        except SQLAlchemyError:
+            # The old hash still works, retry on the next login
+            await session.rollback()
+
     access_token = create_access_token(
-        data={'sub': str(user.id)}, expires_delta=access_token_expires
+        data={'sub': str(user_id)}, expires_delta=ACCESS_TOKEN_EXPIRES
     )
     return Token(access_token=access_token, token_type='bearer')
 
 
 @app.post("/register", status_code=status.HTTP_201_CREATED)
-def register(form_data: RegisterUser, session: SessionDep):
+async def register(form_data: RegisterUser, session: SessionDep):
     """
     Register a new user
     """
@@ -115,19 +204,19 @@ def register(form_data: RegisterUser, session: SessionDep):
     password = form_data.password.strip()
     confirm_password = form_data.confirm_password.strip()
 
-    if not re.match(USERNAME_REGEX, username):
+    if not validate_username(username):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Username must start with a letter, 3-20 chars, letters/numbers/_/. only"
         )
 
-    if not re.match(PASSWORD_REGEX, password):
+    if not validate_password(password):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Password must be at least 6 chars, including a number"
         )
     
-    if not re.match(NUMBER_REGEX, number):
+    if not validate_number(number):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Invalid Phone number"
@@ -139,19 +228,21 @@ def register(form_data: RegisterUser, session: SessionDep):
             detail="Passwords do not match"
         )
 
+    hashed_password = await get_password_hash_async(password)
+
     try:
-        new_user = User(username=username, number=number, password=get_password_hash(password))
+        new_user = User(username=username, number=number, password=hashed_password)
         session.add(new_user)
-        session.commit()
-        session.refresh(new_user)
+        await session.commit()
+        await session.refresh(new_user)
     except IntegrityError:
-        session.rollback()
+        await session.rollback()
         raise HTTPException(
             status_code=status.HTTP_409_CONFLICT,
             detail="Username already taken"
         )
     except SQLAlchemyError as e:
-        session.rollback()
+        await session.rollback()
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Failed to register the user {e}"
@@ -206,20 +297,33 @@ async def add_item(item_data: Annotated[ItemForm, Depends()], session: SessionDe
         if item_data.image.content_type not in ALLOWED_IMAGE_TYPES:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
-                detail=f"Invalid image type. Allowed: {",".join(ALLOWED_IMAGE_TYPES)}"
+                detail=f"Invalid image type. Allowed: {ALLOWED_IMAGE_TYPES_STR}"
             )
-        contents = await item_data.image.read()
 
-        if len(contents) > MAX_IMAGE_SIZE:
+        if item_data.image.size is not None and item_data.image.size > MAX_IMAGE_SIZE:
             raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
                 detail=f"Image size must be less than {MAX_IMAGE_SIZE // (1024 * 1024)} MB"
             )
 
-        # Save the product image in the server
+        # Save the product image in the server, streaming it in chunks so the whole file is never held in memory
         file_path = f"static/uploads/{current_user.id}_{int(time.time())}.jpg"
-        with open(file_path, 'wb') as buffer:
-            buffer.write(contents)
+        partial_path = f"{file_path}.part"
+        size = 0
+        async with aiofiles.open(partial_path, 'wb') as buffer:
+            while chunk := await item_data.image.read(IMAGE_CHUNK_SIZE):
+                size += len(chunk)
+                if size > MAX_IMAGE_SIZE:
+                    break
+                await buffer.write(chunk)
+
+        if size > MAX_IMAGE_SIZE:
+            os.remove(partial_path)
+            raise HTTPException(
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                detail=f"Image size must be less than {MAX_IMAGE_SIZE // (1024 * 1024)} MB"
+            )
+        os.replace(partial_path, file_path)
 
     new_item = Item(
         owner_id=current_user.id,
@@ -233,10 +337,10 @@ async def add_item(item_data: Annotated[ItemForm, Depends()], session: SessionDe
 
     try:
         session.add(new_item)
-        session.commit()
-        session.refresh(new_item)
+        await session.commit()
+        await session.refresh(new_item)
     except SQLAlchemyError as e:
-        session.rollback()
+        await session.rollback()
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Failed to create the item {e}"
@@ -245,27 +349,66 @@ async def add_item(item_data: Annotated[ItemForm, Depends()], session: SessionDe
     return {"success": "Item added successfully"}
 
 
-@app.get("/", response_model=List[Item])
-def list_items(session: SessionDep, search: str | None = None):
+@app.get("/", response_model=ItemListPage)
+async def list_items(
+    session: SessionDep,
+    search: str | None = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: int | None = None
+):
     """
-    Returns the all the active items available for bidding.
+    Returns the active items available for bidding, newest first, one page at a time.
+    Pass the returned next_cursor as cursor to get the next page.
     Also allows to filter items by searching
     """
-    query = select(Item).where(Item.is_active)
+    # Only select the columns shown in the listing so the description is never read or serialized
+    query = select(
+        Item.id,
+        Item.title,
+        Item.image,
+        Item.category,
+        Item.starting_bid,
+        Item.current_bid
+    ).where(Item.is_active, Item.end_at > func.now())
     if search:
         query = query.where(
             (Item.title.ilike(f"%{search}%")) | (Item.description.ilike(f"%{search}%"))
         )
-    items = session.exec(query).all()
-    return items
+    # Keyset pagination: continue after the last id of the previous page instead of using OFFSET
+    if cursor is not None:
+        query = query.where(Item.id < cursor)
+    query = query.order_by(Item.id.desc()).limit(limit)
+    rows = (await session.exec(query)).all()
+
+    items = [
+        ItemListRead(
+            id=row.id,
+            title=row.title,
+            image=row.image,
+            category=row.category,
+            starting_bid=row.starting_bid,
+            current_bid=row.current_bid
+        )
+        for row in rows
+    ]
+    next_cursor = items[-1].id if len(items) == limit else None
+    return ItemListPage(items=items, next_cursor=next_cursor)
 
 
 @app.get("/items/{item_id}", response_model=ItemRead)
-def get_item(item_id: int, session: SessionDep):
+async def get_item(item_id: int, session: SessionDep):
     """
     Returns a item details for given item id
     """
-    item = session.exec(select(Item).where(Item.id == item_id)).first()
+    # Eager load the comments and bids along with their users to avoid a query per row
+    item = await session.get(
+        Item,
+        item_id,
+        options=[
+            selectinload(Item.comments).joinedload(Comment.user),
+            selectinload(Item.bids).joinedload(Bid.user)
+        ]
+    )
     if not item:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -275,7 +418,7 @@ def get_item(item_id: int, session: SessionDep):
 
 
 @app.post("/item/{item_id}/comment", response_model=CommentRead)
-def add_comment(item_id: int, comment_data: CommentCreate, session: SessionDep, current_user: CurrentUserDep):
+async def add_comment(item_id: int, comment_data: CommentCreate, session: SessionDep, current_user: CurrentUserDep):
     """
     Add a new comment to the item
     """
@@ -293,10 +436,10 @@ def add_comment(item_id: int, comment_data: CommentCreate, session: SessionDep,
             comment=comment_data.comment.strip()
         )
         session.add(new_comment)
-        session.commit()
-        session.refresh(new_comment)
+        await session.commit()
+        await session.refresh(new_comment)
     except SQLAlchemyError:
-        session.rollback()
+        await session.rollback()
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Failed to add the comment"
@@ -305,18 +448,26 @@ def add_comment(item_id: int, comment_data: CommentCreate, session: SessionDep,
 
 
 @app.post("/item/{item_id}/bid", response_model=BidRead)
-def add_bid(item_id: int, bid_data: BidCreate, session: SessionDep, current_user: CurrentUserDep):
+async def add_bid(item_id: int, bid_data: BidCreate, session: SessionDep, current_user: CurrentUserDep):
     """
     Add a bid to the item
     """
 
-    item = session.exec(select(Item).where(Item.id == item_id)).first()
+    # Lock the item row until commit so concurrent bids on the same item are applied one at a time
+    item = await session.get(Item, item_id, with_for_update=True)
     if not item:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Item not found"
         )
     
+    # Also check end_at, the scheduled job can be up to a minute late in marking the item inactive
+    if not item.is_active or item.end_at <= datetime.now(timezone.utc):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Auction has ended"
+        )
+
     # Check if the user is bidding in his own item
     if item.owner_id == current_user.id:
         raise HTTPException(
@@ -346,10 +497,10 @@ def add_bid(item_id: int, bid_data: BidCreate, session: SessionDep, current_user
             bid=bid_data.bid
         )
         session.add(new_bid)
-        session.commit()
-        session.refresh(new_bid)
+        await session.commit()
+        await session.refresh(new_bid)
     except SQLAlchemyError:
-        session.rollback()
+        await session.rollback()
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Failed to add the bid"
@@ -358,39 +509,43 @@ def add_bid(item_id: int, bid_data: BidCreate, session: SessionDep, current_user
     return new_bid
 
 
-@app.get("/my-bids", response_model=List[ItemBidInfo])
-def get_my_bids(session: SessionDep, current_user: CurrentUserDep):
+@app.get("/my-bids", response_model=ItemBidInfoPage)
+async def get_my_bids(
+    session: SessionDep,
+    current_user: CurrentUserDep,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: int | None = None
+):
     """
-    List items the user has bid on with their last bid
+    List items the user has bid on with their last bid, most recent bid first, one page at a time.
+    Pass the returned next_cursor as cursor to get the next page.
     """
 
-    # Subquery: latest bid timestamp per item for this user
-    subq = (
-        select(
-            Bid.item_id,
-            func.max(Bid.created_at).label("last_created_at")
-        )
+    # Subquery: latest bid per item for this user, picked with DISTINCT ON from a backward scan of ix_bids_user_item_created
+    latest_bids = (
+        select(Bid)
         .where(Bid.user_id == current_user.id)
-        .group_by(Bid.item_id)
+        .order_by(Bid.item_id.desc(), Bid.created_at.desc())
+        .distinct(Bid.item_id)
         .subquery()
     )
+    last_bid = aliased(Bid, latest_bids)
 
     # Main query: join Item + last Bid
     query = (
-        select(Item, Bid)
-        .join(Bid, Bid.item_id == Item.id)
-        .join(
-            subq,
-            (subq.c.item_id == Bid.item_id) &
-            (subq.c.last_created_at == Bid.created_at)
-        )
-        .where(Bid.user_id == current_user.id)
-        .order_by(subq.c.last_created_at.desc())
+        select(Item, last_bid)
+        .join(last_bid, last_bid.item_id == Item.id)
+        # Bid.user is joined by default, the response does not use it
+        .options(lazyload(last_bid.user), *LIST_QUERY_OPTIONS)
     )
+    # Keyset pagination on the last bid id, newer bids have higher ids
+    if cursor is not None:
+        query = query.where(last_bid.id < cursor)
+    query = query.order_by(last_bid.id.desc()).limit(limit)
 
-    results = session.exec(query).all()
+    results = (await session.exec(query)).all()
 
-    return [
+    items = [
         ItemBidInfo(
             id=item.id,
             title=item.title,
@@ -401,31 +556,68 @@ def get_my_bids(session: SessionDep, current_user: CurrentUserDep):
         )
         for item, bid in results
     ]
+    next_cursor = results[-1][1].id if len(results) == limit else None
+    return ItemBidInfoPage(items=items, next_cursor=next_cursor)
 
 
-@app.get("/my-watchlists")
-def get_watchlists(session: SessionDep, current_user: CurrentUserDep):
+@app.get("/my-watchlists", response_model=List[ItemListRead])
+async def get_watchlists(session: SessionDep, current_user: CurrentUserDep):
+    """
+    List the items in the user's watchlist
+    """
+    query = (
+        select(
+            Item.id,
+            Item.title,
+            Item.image,
+            Item.category,
+            Item.starting_bid,
+            Item.current_bid
+        )
+        .join(Watchlist, Watchlist.item_id == Item.id)
+        .where(Watchlist.user_id == current_user.id)
+        .order_by(Item.id.desc())
+    )
+    rows = (await session.exec(query)).all()
 
-    return current_user.watchlists
+    return [
+        ItemListRead(
+            id=row.id,
+            title=row.title,
+            image=row.image,
+            category=row.category,
+            starting_bid=row.starting_bid,
+            current_bid=row.current_bid
+        )
+        for row in rows
+    ]
 
 
-@app.get("/profile")
-def get_profile(current_user: CurrentUserDep):
-    ...
+@app.get("/profile", response_model=UserProfile)
+async def get_profile(current_user: CurrentUserDep):
+    """
+    Returns the logged in user's profile
+    """
+    return UserProfile(
+        id=current_user.id,
+        username=current_user.username,
+        avatar=current_user.avatar,
+        is_admin=current_user.is_admin
+    )
 
 @app.get("/categories")
-def categories():
+async def categories():
     """
     Get all the categories available
     """
-    return AUCTION_CATEGORIES
+    return AUCTION_CATEGORIES_LIST
 
 
 @app.get("/protected")
-def check(current_user: CurrentUserDep):
+async def check(current_user: CurrentUserDep):
     return {"Success": "You are user"}
 
 
 @app.get("/admins")
-def admins(current_user: CurrentAdminDep):
+async def admins(current_user: CurrentAdminDep):
     return {"Success": "You are admin"}
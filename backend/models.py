@@ -1,5 +1,5 @@
 from sqlmodel import SQLModel, Field, Relationship
-from sqlalchemy import Column, DateTime, String, Boolean, ForeignKey, Enum, func, Float, PrimaryKeyConstraint
+from sqlalchemy import Column, DateTime, String, Boolean, ForeignKey, Enum, func, Float, PrimaryKeyConstraint, Index, text, desc
 from datetime import datetime, timezone
 from typing import List, Optional
 
@@ -8,7 +8,7 @@ class User(SQLModel, table=True):
     __tablename__ = "users"
 
     id: int | None = Field(default=None, primary_key=True)
-    username: str = Field(sa_column=Column(String, unique=True, nullable=False))
+    username: str = Field(sa_column=Column(String, unique=True, index=True, nullable=False))
     password: str
     number: str
     avatar: str = Field(
@@ -48,6 +48,20 @@ class User(SQLModel, table=True):
 
 class Item(SQLModel, table=True):
     __tablename__ = "items"
+    __table_args__ = (
+        # Partial index so the ended auctions job only scans the active items
+        Index("items_active_end_at_idx", "end_at", postgresql_where=text("is_active")),
+        # Newest active items first for the listing, without walking over the ended ones
+        Index("items_active_id_idx", text("id DESC"), postgresql_where=text("is_active")),
+        # Trigram indexes so the ILIKE '%search%' filters in the listing do not scan the whole table
+        Index("items_title_trgm", "title", postgresql_using="gin", postgresql_ops={"title": "gin_trgm_ops"}),
+        Index(
+            "items_description_trgm",
+            "description",
+            postgresql_using="gin",
+            postgresql_ops={"description": "gin_trgm_ops"}
+        ),
+    )
 
     id: int | None = Field(default=None, primary_key=True)
     owner_id: int = Field(sa_column=Column(ForeignKey("users.id", ondelete='CASCADE'), nullable=False))
@@ -70,7 +84,7 @@ class Item(SQLModel, table=True):
         default=None,
         sa_column=Column(ForeignKey("users.id", ondelete='SET NULL'), nullable=True)
     )
-    end_at: datetime
+    end_at: datetime = Field(sa_column=Column(DateTime(timezone=True), nullable=False))
     created_at: datetime = Field(
         default_factory=lambda: datetime.now(timezone.utc),
         sa_column=Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
@@ -94,6 +108,12 @@ class Item(SQLModel, table=True):
 
 class Bid(SQLModel, table=True):
     __tablename__ = "bids"
+    __table_args__ = (
+        # Backs the latest bid per item lookup for a user in my-bids
+        Index("ix_bids_user_item_created", "user_id", "item_id", "created_at"),
+        # Bids of an item, highest first, for picking the winner and loading an item's bids
+        Index("ix_bids_item_bid_created", "item_id", desc("bid"), "created_at"),
+    )
 
     id: int = Field(default=None, primary_key=True)
     user_id: int = Field(sa_column=Column(ForeignKey("users.id", ondelete='CASCADE')))
@@ -105,7 +125,8 @@ class Bid(SQLModel, table=True):
     )
 
     item: Item = Relationship(back_populates='bids')
-    user: User = Relationship(back_populates="bids")
+    # Always needed alongside a bid, load it in the same query
+    user: User = Relationship(back_populates="bids", sa_relationship_kwargs={"lazy": "joined"})
 
 
 class Comment(SQLModel, table=True):
@@ -121,7 +142,8 @@ class Comment(SQLModel, table=True):
     )
 
     item: Item = Relationship(back_populates="comments")
-    user: User = Relationship(back_populates="comments")
+    # Always needed alongside a comment, load it in the same query
+    user: User = Relationship(back_populates="comments", sa_relationship_kwargs={"lazy": "joined"})
 
 
 class Watchlist(SQLModel, table=True):
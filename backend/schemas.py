@@ -40,6 +40,16 @@ class UserRead(BaseModel):
         from_attributes = True
 
 
+class UserProfile(BaseModel):
+    id: int
+    username: str
+    avatar: str
+    is_admin: bool
+
+    class Config:
+        from_attributes = True
+
+
 class CommentRead(BaseModel):
     id: int
     comment: str
@@ -77,6 +87,23 @@ class ItemRead(BaseModel):
         from_attributes = True
 
 
+class ItemListRead(BaseModel):
+    id: int
+    title: str
+    image: str
+    category: str
+    starting_bid: float
+    current_bid: Optional[float] = None
+
+    class Config:
+        from_attributes = True
+
+
+class ItemListPage(BaseModel):
+    items: List[ItemListRead]
+    next_cursor: Optional[int] = None
+
+
 class CommentCreate(BaseModel):
     comment: str
 
@@ -102,4 +129,9 @@ class ItemBidInfo(BaseModel):
     user_last_bid: UserBidRead
 
     class Config:
-        from_attributes = True
\ No newline at end of file
+        from_attributes = True
+
+
+class ItemBidInfoPage(BaseModel):
+    items: List[ItemBidInfo]
+    next_cursor: Optional[int] = None
\ No newline at end of file
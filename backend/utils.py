@@ -1,14 +1,19 @@
-from passlib.context import CryptContext
-from sqlmodel import Session, update
-from database import engine
-from models import Item
-from datetime import datetime, timezone
+from argon2 import PasswordHasher, Type
+from argon2.low_level import verify_secret
+from argon2.exceptions import VerificationError, InvalidHashError
+import bcrypt
+import anyio
+from concurrent.futures import ThreadPoolExecutor
+import os
+import re
+import string
 
 
-USERNAME_REGEX = r'^[a-zA-Z][a-zA-Z0-9_.]{2,19}$'
-PASSWORD_REGEX = r'^(?=.*\d)[A-Za-z\d]{6,}$'
-NUMBER_REGEX = r'^(?:97|98)\d{8}$'
-AUCTION_CATEGORIES = {
+USERNAME_REGEX = re.compile(r'^[a-zA-Z][a-zA-Z0-9_.]{2,19}$')
+PASSWORD_REGEX = re.compile(r'^(?=.*\d)[A-Za-z\d]{6,}$')
+NUMBER_REGEX = re.compile(r'^(?:97|98)\d{8}$')
+# Ordered for display in /categories
+AUCTION_CATEGORIES_LIST = (
     "Electronics",
     "Fashion",
     "Home & Garden",
@@ -20,25 +25,111 @@ AUCTION_CATEGORIES = {
     "Jewelry",
     "Vehicles",
     "Miscellaneous"
-}
+)
+AUCTION_CATEGORIES = frozenset(AUCTION_CATEGORIES_LIST)
 
-pwd_context = CryptContext(schemes=['bcrypt'])
+# Argon2id, defaults to the OWASP recommended parameters (19 MiB memory, 2 iterations, 1 lane).
+# Hashing cost grows linearly with both values, tune them per deployment through the environment
+ARGON2_TIME_COST = int(os.getenv('ARGON2_TIME_COST', '2'))
+ARGON2_MEMORY_COST = int(os.getenv('ARGON2_MEMORY_COST', '19456'))
+ph = PasswordHasher(time_cost=ARGON2_TIME_COST, memory_cost=ARGON2_MEMORY_COST, parallelism=1, hash_len=32)
+ARGON2ID_PREFIX = '$argon2id$'
+
+# Only used to verify the bcrypt hashes stored before the switch to argon2
+LEGACY_BCRYPT_PREFIXES = ('$2a$', '$2b$', '$2y$')
+BCRYPT_MAX_BYTES = 72
+
+
+USERNAME_CHARS = string.ascii_letters + string.digits + '_.'
+
+
+# The validators below implement the patterns above with str methods, which avoids running the regex engine
+def validate_username(username) -> bool:
+    return (
+        3 <= len(username) <= 20
+        and username[0].isalpha()
+        and not username.strip(USERNAME_CHARS)
+    )
+
+
+def validate_password(password) -> bool:
+    # All ascii letters and digits, so it contains a digit unless it is all letters
+    return (
+        len(password) >= 6
+        and password.isascii()
+        and password.isalnum()
+        and not password.isalpha()
+    )
+
+
+def validate_number(number) -> bool:
+    return (
+        len(number) == 10
+        and number.isascii()
+        and number.isdigit()
+        and number.startswith(('97', '98'))
+    )
 
 
 def get_password_hash(plain_password) -> str:
-    return pwd_context.hash(plain_password)
+    return ph.hash(plain_password)
+
+
+# Checked when there is no stored hash, so a missing user costs one verify just like a wrong password
+_DUMMY_HASH = ph.hash("__never_matches__")
 
 
 def verify_password(plain_password, hashed_password) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
-
-
-def mark_ended_auctions():
-    with Session(engine) as session:
-        stmt = (
-            update(Item)
-            .where(Item.end_at <= datetime.now(timezone.utc))
-            .values(is_active=False)
-        )
-        session.exec(stmt)
-        session.commit()
+    if hashed_password is None:
+        verify_password(plain_password, _DUMMY_HASH)
+        return False
+    if hashed_password.startswith(ARGON2ID_PREFIX):
+        # Every hash this app writes, verify it directly and skip the PasswordHasher type lookup
+        try:
+            return verify_secret(hashed_password.encode('ascii'), plain_password.encode('utf-8'), Type.ID)
+        except VerificationError:
+            return False
+    if hashed_password.startswith(LEGACY_BCRYPT_PREFIXES):
+        # bcrypt only ever saw the first 72 bytes, truncate explicitly as newer backends reject longer input
+        try:
+            return bcrypt.checkpw(plain_password.encode('utf-8')[:BCRYPT_MAX_BYTES], hashed_password.encode('utf-8'))
+        except ValueError:
+            return False
+    try:
+        return ph.verify(hashed_password, plain_password)
+    except (VerificationError, InvalidHashError):
+        return False
+
+
+def password_needs_rehash(hashed_password) -> bool:
+    """
+    True for legacy bcrypt hashes and argon2 hashes made with other parameters than the current ones
+    """
+    if hashed_password.startswith(LEGACY_BCRYPT_PREFIXES):
+        return True
+    return ph.check_needs_rehash(hashed_password)
+
+
+def verify_many(pairs) -> list[bool]:
+    """
+    Verifies (plain_password, hashed_password) pairs in parallel, one thread per core.
+    argon2 and bcrypt release the GIL so the verifies really run concurrently
+    """
+    pairs = list(pairs)
+    if not pairs:
+        return []
+    with ThreadPoolExecutor(max_workers=min(len(pairs), os.cpu_count() or 1)) as executor:
+        return list(executor.map(lambda pair: verify_password(*pair), pairs))
+
+
+# Hashing is CPU bound and argon2/bcrypt release the GIL, so running it on up to one thread per core
+# keeps the event loop free without oversubscribing the CPU or holding many 19 MiB argon2 buffers at once
+hashing_limiter = anyio.CapacityLimiter(os.cpu_count() or 1)
+
+
+async def get_password_hash_async(plain_password) -> str:
+    return await anyio.to_thread.run_sync(get_password_hash, plain_password, limiter=hashing_limiter)
+
+
+async def verify_password_async(plain_password, hashed_password) -> bool:
+    return await anyio.to_thread.run_sync(verify_password, plain_password, hashed_password, limiter=hashing_limiter)